@@ -1,23 +1,245 @@
 """
 Lab Slip API Helper Functions
 Provides Python interface to Supabase lab slip operations
+
+Database prerequisites (see migrations/):
+- add_append_lab_slip_status_function.sql: RPC used by update_lab_slip_status
+- cap_lab_slip_status_history.sql: caps that RPC's status_history at 50 entries
+- add_lab_slip_query_indexes.sql: idx_lab_slips_overdue (partial index for
+  get_overdue_lab_slips) and idx_lab_slips_status_created_at (for
+  list_lab_slips(status=...))
+- add_lab_slip_due_date_default.sql: due_date default used when create_lab_slip
+  and create_lab_slips_bulk omit it
 """
 import os
 import json
-from typing import Dict, List, Optional
+import asyncio
+import copy
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, List, Optional, Tuple
 from datetime import datetime, timedelta
 
+# CDT codes for crowns that require a lab slip
+CROWN_CODES = frozenset({'D2740', 'D2750', 'D2751', 'D2752', 'D2780', 'D2781', 'D2782', 'D2783'})
+
+# Default projection for list queries; pass columns='*' for full rows
+LIST_COLUMNS = 'id,patient_name,procedure_code,status,due_date,lab_id'
+LAB_EMBED = 'labs(name,email)'
+
+# Rows per INSERT request in create_lab_slips_bulk, to stay under PostgREST payload limits
+BULK_INSERT_CHUNK_SIZE = 1000
+
+# Keep-alive connections to PostgREST; size this to the expected number of concurrent workflows
+DEFAULT_POOL_SIZE = 25
+
+
+def create_supabase_client(url: Optional[str] = None, key: Optional[str] = None,
+                           pool_size: int = DEFAULT_POOL_SIZE):
+    """
+    Create a Supabase client whose requests share a pooled keep-alive HTTP/2 connection
+    
+    Args:
+        url: Supabase project URL (defaults to SUPABASE_URL)
+        key: Service role key (defaults to SUPABASE_SERVICE_ROLE_KEY)
+        pool_size: Number of keep-alive connections; roughly the max concurrent workflows
+        
+    Returns:
+        Supabase client instance
+    """
+    import httpx
+    from supabase import create_client
+    from supabase.lib.client_options import SyncClientOptions
+    
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=pool_size,
+                            max_connections=pool_size * 2)
+    )
+    return create_client(
+        url or os.environ['SUPABASE_URL'],
+        key or os.environ['SUPABASE_SERVICE_ROLE_KEY'],
+        options=SyncClientOptions(httpx_client=http_client)
+    )
+
+
+@dataclass(slots=True)
+class LabSlipRow:
+    """In-memory lab_slips row, converted to a dict only when sent to Supabase"""
+    patient_name: str
+    patient_dob: Optional[str]
+    procedure_code: str
+    procedure_description: Optional[str]
+    tooth_number: Optional[str]
+    shade: Optional[str]
+    special_instructions: Optional[str]
+    due_date: Optional[str]
+    status: str
+    lab_id: Optional[str]
+    opendental_patient_id: Optional[int]
+    opendental_procedure_id: Optional[int]
+    opendental_appointment_id: Optional[int]
+    lab_slip_data: Dict
+    
+    def to_dict(self) -> Dict:
+        """Convert to an insert payload, leaving due_date to the column default when unset"""
+        row = {name: getattr(self, name) for name in self.__slots__}
+        if row['due_date'] is None:
+            del row['due_date']
+        return row
+
+
+@dataclass
+class CacheEntry:
+    """Cached value with its insertion time and time-to-live"""
+    value: Any
+    timestamp: float
+    ttl: float
+    
+    def is_expired(self) -> bool:
+        return time.monotonic() - self.timestamp > self.ttl
+
+
+class QueryCache:
+    """
+    Thread-safe TTL cache with LRU eviction for read queries
+    
+    Values are deep-copied on set and get, so callers may mutate what they
+    store or receive without changing the cached entry.
+    
+    Each key has a generation that invalidate() bumps. A reader that takes
+    generation(key) before querying and passes it to set() will not cache a
+    result fetched before a concurrent invalidation. Generations are only
+    tracked while a reader holds one, so the reader must call
+    release_generation(key) when it is done.
+    """
+    
+    def __init__(self, default_ttl: float = 60, max_size: int = 1024):
+        """
+        Initialize cache
+        
+        Args:
+            default_ttl: Seconds an entry stays valid when no ttl is given
+            max_size: Maximum number of entries before least recently used are evicted
+        """
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self._entries: 'OrderedDict[Hashable, CacheEntry]' = OrderedDict()
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        # key -> [generation, readers holding it]
+        self._generations: Dict[Hashable, List[int]] = {}
+        self._epoch = 0
+    
+    def generation(self, key: Hashable) -> Tuple[int, int]:
+        """Return the current generation of key and register the caller as a reader"""
+        with self._lock:
+            tracked = self._generations.setdefault(key, [0, 0])
+            tracked[1] += 1
+            return self._epoch, tracked[0]
+    
+    def release_generation(self, key: Hashable) -> None:
+        """Unregister a reader of key, forgetting its generation once none remain"""
+        with self._lock:
+            tracked = self._generations.get(key)
+            if tracked is None:
+                return
+            tracked[1] -= 1
+            if tracked[1] <= 0:
+                del self._generations[key]
+    
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.is_expired():
+                if entry is not None:
+                    del self._entries[key]
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return copy.deepcopy(entry.value)
+    
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None,
+            generation: Optional[Tuple[int, int]] = None) -> None:
+        """
+        Store value under key
+        
+        Args:
+            key: Cache key
+            value: Value to store
+            ttl: Seconds the entry stays valid (defaults to default_ttl)
+            generation: If given, only store when key has not been invalidated since
+                this generation was read
+        """
+        with self._lock:
+            if generation is not None:
+                tracked = self._generations.get(key)
+                if tracked is None or generation != (self._epoch, tracked[0]):
+                    return
+            self._entries[key] = CacheEntry(copy.deepcopy(value), time.monotonic(),
+                                            self.default_ttl if ttl is None else ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, key: Hashable) -> None:
+        """Remove key from the cache if present and bump its generation"""
+        with self._lock:
+            self._entries.pop(key, None)
+            # Untracked keys have no reader whose set() needs rejecting
+            tracked = self._generations.get(key)
+            if tracked is not None:
+                tracked[0] += 1
+    
+    def clear(self) -> None:
+        """Remove all entries and bump every generation"""
+        with self._lock:
+            self._entries.clear()
+            self._epoch += 1
+    
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'size': len(self._entries)
+            }
+
+
 class LabSlipAPI:
     """API interface for lab slip operations"""
     
-    def __init__(self, supabase_client=None):
+    def __init__(self, supabase_client=None, cache_ttl: float = 60):
         """
         Initialize API with Supabase client
         
         Args:
             supabase_client: Supabase client instance (optional for documentation)
+            cache_ttl: Seconds to cache get_lab_slip / get_pending_lab_slips results
         """
         self.supabase = supabase_client
+        self.cache = QueryCache(default_ttl=cache_ttl)
+        # In-flight get_lab_slip queries, so concurrent callers share one request
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls, pool_size: int = DEFAULT_POOL_SIZE, cache_ttl: float = 60) -> 'LabSlipAPI':
+        """
+        Create an API backed by a pooled Supabase client configured from the environment
+        
+        Args:
+            pool_size: Number of keep-alive connections; roughly the max concurrent workflows
+            cache_ttl: Seconds to cache get_lab_slip / get_pending_lab_slips results
+        """
+        return cls(create_supabase_client(pool_size=pool_size), cache_ttl=cache_ttl)
     
     def create_lab_slip(self, procedure_data: Dict) -> Dict:
         """
@@ -33,35 +255,84 @@ class LabSlipAPI:
                 - shade: str (optional)
                 - special_instructions: str (optional)
                 - lab_id: str (optional, defaults to default lab)
+                - due_date: str (optional, defaults to 14 days out server-side)
                 
         Returns:
             Dictionary with created lab slip data
         """
-        # Calculate due date (typically 2 weeks from now)
-        due_date = (datetime.now() + timedelta(days=14)).date()
-        
-        lab_slip_data = {
-            'patient_name': procedure_data['patient_name'],
-            'patient_dob': procedure_data.get('patient_dob'),
-            'procedure_code': procedure_data['procedure_code'],
-            'procedure_description': procedure_data.get('procedure_description'),
-            'tooth_number': procedure_data.get('tooth_number'),
-            'shade': procedure_data.get('shade'),
-            'special_instructions': procedure_data.get('special_instructions'),
-            'due_date': due_date.isoformat(),
-            'status': 'pending',
-            'lab_id': procedure_data.get('lab_id'),  # Will use default if None
-            'opendental_patient_id': procedure_data.get('opendental_patient_id'),
-            'opendental_procedure_id': procedure_data.get('opendental_procedure_id'),
-            'opendental_appointment_id': procedure_data.get('opendental_appointment_id'),
-            'lab_slip_data': procedure_data.get('additional_data', {})
-        }
+        row = self._build_row(procedure_data)
         
         if self.supabase:
-            result = self.supabase.table('lab_slips').insert(lab_slip_data).execute()
+            try:
+                result = self.supabase.table('lab_slips').insert(row.to_dict()).execute()
+            finally:
+                # The insert may have committed even if the response failed
+                self.cache.invalidate(('pending',))
             return result.data[0] if result.data else None
         
-        return lab_slip_data
+        if row.due_date is None:
+            row.due_date = self._default_due_date(datetime.now())
+        return row.to_dict()
+    
+    def create_lab_slips_bulk(self, procedures: List[Dict]) -> List[Dict]:
+        """
+        Create lab slips for many procedures with multi-row inserts
+        
+        Batches larger than BULK_INSERT_CHUNK_SIZE are sent as several inserts and
+        are not atomic: if a later chunk fails, earlier chunks stay committed.
+        
+        Args:
+            procedures: List of procedure dictionaries (same keys as create_lab_slip)
+            
+        Returns:
+            List of created lab slip records
+        """
+        rows = [self._build_row(proc) for proc in procedures]
+        
+        # PostgREST takes the column list from the first row of a multi-row insert,
+        # so only rely on the column default when no row sets due_date
+        if not self.supabase or any(row.due_date for row in rows):
+            default_due_date = self._default_due_date(datetime.now())
+            for row in rows:
+                if row.due_date is None:
+                    row.due_date = default_due_date
+        
+        if self.supabase:
+            created = []
+            try:
+                for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+                    chunk = [row.to_dict() for row in rows[start:start + BULK_INSERT_CHUNK_SIZE]]
+                    result = self.supabase.table('lab_slips').insert(chunk).execute()
+                    created.extend(result.data or [])
+            finally:
+                # Earlier chunks may have been committed even if a later one failed
+                self.cache.invalidate(('pending',))
+            return created
+        
+        return [row.to_dict() for row in rows]
+    
+    def _default_due_date(self, now: datetime) -> str:
+        """Client-side due date (2 weeks out), matching the due_date column default"""
+        return (now + timedelta(days=14)).date().isoformat()
+    
+    def _build_row(self, procedure_data: Dict) -> LabSlipRow:
+        """Build a lab_slips row from procedure data"""
+        return LabSlipRow(
+            patient_name=procedure_data['patient_name'],
+            patient_dob=procedure_data.get('patient_dob'),
+            procedure_code=procedure_data['procedure_code'],
+            procedure_description=procedure_data.get('procedure_description'),
+            tooth_number=procedure_data.get('tooth_number'),
+            shade=procedure_data.get('shade'),
+            special_instructions=procedure_data.get('special_instructions'),
+            due_date=procedure_data.get('due_date'),
+            status='pending',
+            lab_id=procedure_data.get('lab_id'),  # Will use default if None
+            opendental_patient_id=procedure_data.get('opendental_patient_id'),
+            opendental_procedure_id=procedure_data.get('opendental_procedure_id'),
+            opendental_appointment_id=procedure_data.get('opendental_appointment_id'),
+            lab_slip_data=procedure_data.get('additional_data', {})
+        )
     
     def get_lab_slip(self, lab_slip_id: str) -> Optional[Dict]:
         """
@@ -74,28 +345,69 @@ class LabSlipAPI:
             Lab slip data or None if not found
         """
         if self.supabase:
-            result = self.supabase.table('lab_slips')\
-                .select('*, labs(*)')\
-                .eq('id', lab_slip_id)\
-                .single()\
-                .execute()
-            return result.data if result.data else None
+            key = ('lab_slip', lab_slip_id)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            
+            with self._inflight_lock:
+                future = self._inflight.get(lab_slip_id)
+                owner = future is None
+                if owner:
+                    future = Future()
+                    self._inflight[lab_slip_id] = future
+                    generation = self.cache.generation(key)
+            
+            if not owner:
+                # Each waiter gets its own copy of the shared result
+                return copy.deepcopy(future.result())
+            
+            try:
+                result = self.supabase.table('lab_slips')\
+                    .select('*, labs(*)')\
+                    .eq('id', lab_slip_id)\
+                    .single()\
+                    .execute()
+                data = result.data if result.data else None
+                if data:
+                    # Skipped if the slip was updated while this query was in flight
+                    self.cache.set(key, data, generation=generation)
+                # Waiters copy from a private snapshot, so the owner may mutate data
+                future.set_result(copy.deepcopy(data))
+                return data
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            finally:
+                self.cache.release_generation(key)
+                with self._inflight_lock:
+                    # An update may already have replaced or dropped this entry
+                    if self._inflight.get(lab_slip_id) is future:
+                        del self._inflight[lab_slip_id]
         
         return None
     
-    def list_lab_slips(self, status: Optional[str] = None, limit: int = 50) -> List[Dict]:
+    def _select_columns(self, columns: str, include_lab: bool) -> str:
+        """Build a select string, optionally embedding the related lab"""
+        return f'{columns},{LAB_EMBED}' if include_lab else columns
+    
+    def list_lab_slips(self, status: Optional[str] = None, limit: int = 50,
+                       columns: str = LIST_COLUMNS, include_lab: bool = True) -> List[Dict]:
         """
         List lab slips with optional filtering
         
         Args:
             status: Filter by status (pending, sent, in_progress, completed, cancelled)
             limit: Maximum number of results
+            columns: Comma-separated lab_slips columns to select
+            include_lab: Whether to embed the related lab's name and email
             
         Returns:
             List of lab slip records
         """
         if self.supabase:
-            query = self.supabase.table('lab_slips').select('*, labs(*)')
+            query = self.supabase.table('lab_slips')\
+                .select(self._select_columns(columns, include_lab))
             
             if status:
                 query = query.eq('status', status)
@@ -112,66 +424,114 @@ class LabSlipAPI:
         Args:
             lab_slip_id: UUID of the lab slip
             status: New status (pending, sent, in_progress, completed, cancelled)
-            notes: Optional notes about the status change
+            notes: Optional notes about the status change; appended to
+                lab_slip_data.status_history, which keeps the 50 most recent entries
             
         Returns:
             Updated lab slip data
         """
+        now_iso = datetime.now().isoformat()
+        
+        if self.supabase:
+            # Status, timestamps and status_history are written server-side
+            # in one statement (see migrations/add_append_lab_slip_status_function.sql)
+            try:
+                result = self.supabase.rpc('append_lab_slip_status', {
+                    'p_lab_slip_id': lab_slip_id,
+                    'p_status': status,
+                    'p_notes': notes or None,
+                    'p_ts': now_iso
+                }).execute()
+            finally:
+                # The update may have committed even if the response failed
+                self.cache.invalidate(('lab_slip', lab_slip_id))
+                self.cache.invalidate(('pending',))
+                # Reads started before the update may return the old row; later
+                # callers should not join them
+                with self._inflight_lock:
+                    self._inflight.pop(lab_slip_id, None)
+            return result.data[0] if result.data else None
+        
         update_data = {
             'status': status,
-            'updated_at': datetime.now().isoformat()
+            'updated_at': now_iso
         }
         
         # Set timestamp fields based on status
         if status == 'sent':
-            update_data['sent_at'] = datetime.now().isoformat()
+            update_data['sent_at'] = now_iso
         elif status == 'completed':
-            update_data['completed_at'] = datetime.now().isoformat()
-        
-        if notes:
-            # Add notes to lab_slip_data
-            if self.supabase:
-                current = self.get_lab_slip(lab_slip_id)
-                if current:
-                    lab_data = current.get('lab_slip_data', {})
-                    if 'status_history' not in lab_data:
-                        lab_data['status_history'] = []
-                    lab_data['status_history'].append({
-                        'status': status,
-                        'notes': notes,
-                        'timestamp': datetime.now().isoformat()
-                    })
-                    update_data['lab_slip_data'] = lab_data
-        
-        if self.supabase:
-            result = self.supabase.table('lab_slips')\
-                .update(update_data)\
-                .eq('id', lab_slip_id)\
-                .execute()
-            return result.data[0] if result.data else None
+            update_data['completed_at'] = now_iso
         
         return update_data
     
-    def detect_crown_procedures(self, procedures: List[Dict]) -> List[Dict]:
+    async def create_lab_slip_async(self, procedure_data: Dict) -> Dict:
+        """Async version of create_lab_slip, run in a worker thread"""
+        return await asyncio.to_thread(self.create_lab_slip, procedure_data)
+    
+    async def get_lab_slip_async(self, lab_slip_id: str) -> Optional[Dict]:
+        """Async version of get_lab_slip, run in a worker thread"""
+        return await asyncio.to_thread(self.get_lab_slip, lab_slip_id)
+    
+    async def update_lab_slip_status_async(self, lab_slip_id: str, status: str,
+                                           notes: Optional[str] = None) -> Dict:
+        """Async version of update_lab_slip_status, run in a worker thread"""
+        return await asyncio.to_thread(self.update_lab_slip_status, lab_slip_id, status, notes)
+    
+    async def get_lab_slips_async(self, lab_slip_ids: List[str]) -> List[Optional[Dict]]:
+        """
+        Retrieve several lab slips concurrently
+        
+        Args:
+            lab_slip_ids: UUIDs of the lab slips
+            
+        Returns:
+            Lab slip data (or None) in the same order as lab_slip_ids
+        """
+        return await asyncio.gather(*(self.get_lab_slip_async(i) for i in lab_slip_ids))
+    
+    async def update_lab_slip_statuses_async(
+            self, updates: List[Tuple[str, str, Optional[str]]]) -> List[Dict]:
+        """
+        Apply independent status updates concurrently
+        
+        Each update should target a different lab slip; successive updates to the
+        same slip must be awaited in order with update_lab_slip_status_async.
+        
+        Args:
+            updates: List of (lab_slip_id, status, notes) tuples
+            
+        Returns:
+            Updated lab slip data in the same order as updates
+        """
+        return await asyncio.gather(*(
+            self.update_lab_slip_status_async(lab_slip_id, status, notes)
+            for lab_slip_id, status, notes in updates
+        ))
+    
+    def detect_crown_procedures(self, procedures: List[Dict],
+                                already_upper: bool = False) -> List[Dict]:
         """
         Detect crown procedures that need lab slips
         
         Args:
             procedures: List of procedure dictionaries from Open Dental
                 Each should have: procedure_code, patient_name, etc.
+            already_upper: Set when procedure codes are known to be upper-case
+                (as Open Dental returns them) to skip case normalization
                 
         Returns:
             List of procedures that need lab slips (crown codes)
         """
-        crown_codes = ['D2740', 'D2750', 'D2751', 'D2752', 'D2780', 'D2781', 'D2782', 'D2783']
-        
-        crown_procedures = []
-        for proc in procedures:
-            proc_code = proc.get('procedure_code', '').upper()
-            if proc_code in crown_codes:
-                crown_procedures.append(proc)
-        
-        return crown_procedures
+        if already_upper:
+            return [
+                proc for proc in procedures
+                if proc.get('procedure_code', '') in CROWN_CODES
+            ]
+        return [
+            proc for proc in procedures
+            if proc.get('procedure_code', '').upper() in CROWN_CODES
+        ]
     
     def generate_pdf_for_lab_slip(self, lab_slip_id: str) -> Dict:
         """
@@ -198,22 +558,45 @@ class LabSlipAPI:
         """
         Get all pending lab slips that need attention
         
+        Results are cached; see QueryCache.
+        
         Returns:
-            List of pending lab slips
+            List of pending lab slips, projected to LIST_COLUMNS plus the
+            embedded lab (not full rows; use list_lab_slips(status='pending',
+            columns='*') for those)
         """
-        return self.list_lab_slips(status='pending')
+        if not self.supabase:
+            return []
+        
+        key = ('pending',)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        
+        generation = self.cache.generation(key)
+        try:
+            pending = self.list_lab_slips(status='pending')
+            self.cache.set(key, pending, generation=generation)
+        finally:
+            self.cache.release_generation(key)
+        return pending
     
-    def get_overdue_lab_slips(self) -> List[Dict]:
+    def get_overdue_lab_slips(self, columns: str = LIST_COLUMNS,
+                              include_lab: bool = True) -> List[Dict]:
         """
         Get lab slips that are overdue (past due date and not completed)
         
+        Args:
+            columns: Comma-separated lab_slips columns to select
+            include_lab: Whether to embed the related lab's name and email
+        
         Returns:
             List of overdue lab slips
         """
         if self.supabase:
             today = datetime.now().date().isoformat()
             result = self.supabase.table('lab_slips')\
-                .select('*, labs(*)')\
+                .select(self._select_columns(columns, include_lab))\
                 .lt('due_date', today)\
                 .neq('status', 'completed')\
                 .neq('status', 'cancelled')\
@@ -233,13 +616,16 @@ def main():
     print()
     print("Available Methods:")
     print("- create_lab_slip(procedure_data)")
+    print("- create_lab_slips_bulk(procedures)")
     print("- get_lab_slip(lab_slip_id)")
-    print("- list_lab_slips(status=None, limit=50)")
+    print("- list_lab_slips(status=None, limit=50, columns=LIST_COLUMNS, include_lab=True)")
     print("- update_lab_slip_status(lab_slip_id, status, notes=None)")
-    print("- detect_crown_procedures(procedures)")
+    print("- get_lab_slips_async(lab_slip_ids)")
+    print("- update_lab_slip_statuses_async(updates)")
+    print("- detect_crown_procedures(procedures, already_upper=False)")
     print("- generate_pdf_for_lab_slip(lab_slip_id)")
     print("- get_pending_lab_slips()")
-    print("- get_overdue_lab_slips()")
+    print("- get_overdue_lab_slips(columns=LIST_COLUMNS, include_lab=True)")
     print()
     print("Example: Creating a lab slip")
     print("-" * 50)
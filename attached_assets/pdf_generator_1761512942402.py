@@ -5,39 +5,51 @@ Generates professional dental laboratory prescription PDFs
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import inch
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from datetime import datetime
-from typing import Dict, Optional
+from io import BytesIO
+from typing import BinaryIO, Dict, List, Optional, Union
 import os
 
+# Characters replaced with '_' in PDF filenames: space, control characters
+# (including tab/newline) and path/shell-unsafe punctuation
+_SAFE_TABLE = str.maketrans({c: '_' for c in ' /\\:*?"<>|\'\x7f' + ''.join(map(chr, range(32)))})
+
+PRACTICE_INFO = {
+    'name': 'Huntington Beach Dental Center',
+    'address': '17692 Beach Blvd STE 310',
+    'city_state_zip': 'Huntington Beach, CA 92647',
+    'phone': '714-842-5035'
+}
+
+# Load font metrics at import so the first PDF doesn't pay for it
+for _font_name in ("Helvetica", "Helvetica-Bold"):
+    pdfmetrics.getFont(_font_name)
+
 class LabSlipPDFGenerator:
     """Generate professional lab slip PDFs for dental procedures"""
     
     def __init__(self):
-        self.practice_info = {
-            'name': 'Huntington Beach Dental Center',
-            'address': '17692 Beach Blvd STE 310',
-            'city_state_zip': 'Huntington Beach, CA 92647',
-            'phone': '714-842-5035'
-        }
+        # Per-instance copy; edits take effect on the next generate() call
+        self.practice_info = dict(PRACTICE_INFO)
     
-    def generate(self, lab_slip_data: Dict, output_path: str) -> str:
+    def _draw_header(self, c: canvas.Canvas, text) -> float:
         """
-        Generate a lab slip PDF
+        Draw the title, rule and practice information
         
         Args:
-            lab_slip_data: Dictionary containing lab slip information
-            output_path: Path where PDF should be saved
+            c: Canvas to draw rules on
+            text: Text object that receives the header text
             
         Returns:
-            Path to generated PDF
+            Y position below the header
         """
-        # Create PDF
-        c = canvas.Canvas(output_path, pagesize=letter)
         width, height = letter
         
-        # Header
-        c.setFont("Helvetica-Bold", 18)
-        c.drawString(1*inch, height - 0.75*inch, "DENTAL LABORATORY PRESCRIPTION")
+        text.setFont("Helvetica-Bold", 18)
+        text.setTextOrigin(1*inch, height - 0.75*inch)
+        text.textOut("DENTAL LABORATORY PRESCRIPTION")
         
         # Draw horizontal line
         c.setLineWidth(2)
@@ -45,36 +57,85 @@ class LabSlipPDFGenerator:
         
         # Practice Information Section
         y_position = height - 1.3*inch
-        c.setFont("Helvetica-Bold", 12)
-        c.drawString(1*inch, y_position, "FROM:")
+        text.setFont("Helvetica-Bold", 12)
+        text.setTextOrigin(1*inch, y_position)
+        text.textOut("FROM:")
         
-        c.setFont("Helvetica", 10)
+        text.setFont("Helvetica", 10)
         y_position -= 0.2*inch
-        c.drawString(1*inch, y_position, self.practice_info['name'])
+        text.setTextOrigin(1*inch, y_position)
+        text.textOut(self.practice_info['name'])
         y_position -= 0.15*inch
-        c.drawString(1*inch, y_position, self.practice_info['address'])
+        text.setTextOrigin(1*inch, y_position)
+        text.textOut(self.practice_info['address'])
         y_position -= 0.15*inch
-        c.drawString(1*inch, y_position, self.practice_info['city_state_zip'])
+        text.setTextOrigin(1*inch, y_position)
+        text.textOut(self.practice_info['city_state_zip'])
         y_position -= 0.15*inch
-        c.drawString(1*inch, y_position, f"Phone: {self.practice_info['phone']}")
+        text.setTextOrigin(1*inch, y_position)
+        text.textOut(f"Phone: {self.practice_info['phone']}")
+        
+        return y_position
+    
+    def generate(self, lab_slip_data: Dict,
+                 output: Union[str, BinaryIO, None] = None) -> Union[str, BinaryIO, bytes]:
+        """
+        Generate a lab slip PDF
+        
+        Args:
+            lab_slip_data: Dictionary containing lab slip information
+            output: Path where PDF should be saved, a binary file-like object to
+                write into, or None to render in memory
+            
+        Returns:
+            The path or file-like object passed as output, or the PDF bytes if output is None
+        """
+        # Pull fields into locals once
+        get = lab_slip_data.get
+        slip_id = get('id')
+        lab_name = get('lab_name', 'Laboratory')
+        lab_contact = get('lab_contact')
+        lab_email = get('lab_email')
+        patient_name = get('patient_name', 'Unknown Patient')
+        dob = get('patient_dob')
+        procedure_code = get('procedure_code', 'N/A')
+        procedure_desc = get('procedure_description')
+        tooth_number = get('tooth_number')
+        shade = get('shade')
+        due_date = get('due_date')
+        instructions = get('special_instructions')
+        
+        # Create PDF
+        buffer = BytesIO() if output is None else None
+        c = canvas.Canvas(buffer if output is None else output, pagesize=letter)
+        width, height = letter
+        
+        # All text goes into one text object; lines are drawn on the canvas directly
+        text = c.beginText()
+        
+        # Header and practice information
+        y_position = self._draw_header(c, text)
+        
+        def draw_line(value: str) -> None:
+            text.setTextOrigin(1*inch, y_position)
+            text.textOut(value)
         
         # Lab Information Section
         y_position -= 0.4*inch
-        c.setFont("Helvetica-Bold", 12)
-        c.drawString(1*inch, y_position, "TO:")
+        text.setFont("Helvetica-Bold", 12)
+        draw_line("TO:")
         
-        c.setFont("Helvetica", 10)
+        text.setFont("Helvetica", 10)
         y_position -= 0.2*inch
-        lab_name = lab_slip_data.get('lab_name', 'Laboratory')
-        c.drawString(1*inch, y_position, f"Lab: {lab_name}")
+        draw_line(f"Lab: {lab_name}")
         
-        if lab_slip_data.get('lab_contact'):
+        if lab_contact:
             y_position -= 0.15*inch
-            c.drawString(1*inch, y_position, f"Contact: {lab_slip_data['lab_contact']}")
+            draw_line(f"Contact: {lab_contact}")
         
-        if lab_slip_data.get('lab_email'):
+        if lab_email:
             y_position -= 0.15*inch
-            c.drawString(1*inch, y_position, f"Email: {lab_slip_data['lab_email']}")
+            draw_line(f"Email: {lab_email}")
         
         # Draw section divider
         y_position -= 0.3*inch
@@ -83,93 +144,96 @@ class LabSlipPDFGenerator:
         
         # Patient Information Section
         y_position -= 0.3*inch
-        c.setFont("Helvetica-Bold", 12)
-        c.drawString(1*inch, y_position, "PATIENT INFORMATION")
+        text.setFont("Helvetica-Bold", 12)
+        draw_line("PATIENT INFORMATION")
         
-        c.setFont("Helvetica", 10)
+        text.setFont("Helvetica", 10)
         y_position -= 0.25*inch
-        patient_name = lab_slip_data.get('patient_name', 'Unknown Patient')
-        c.drawString(1*inch, y_position, f"Name: {patient_name}")
+        draw_line(f"Name: {patient_name}")
         
-        if lab_slip_data.get('patient_dob'):
+        if dob:
             y_position -= 0.15*inch
-            dob = lab_slip_data['patient_dob']
             if isinstance(dob, str):
-                c.drawString(1*inch, y_position, f"Date of Birth: {dob}")
+                draw_line(f"Date of Birth: {dob}")
             else:
-                c.drawString(1*inch, y_position, f"Date of Birth: {dob.strftime('%m/%d/%Y')}")
+                draw_line(f"Date of Birth: {dob.strftime('%m/%d/%Y')}")
         
         # Procedure Information Section
         y_position -= 0.4*inch
-        c.setFont("Helvetica-Bold", 12)
-        c.drawString(1*inch, y_position, "PROCEDURE INFORMATION")
+        text.setFont("Helvetica-Bold", 12)
+        draw_line("PROCEDURE INFORMATION")
         
-        c.setFont("Helvetica", 10)
+        text.setFont("Helvetica", 10)
         y_position -= 0.25*inch
-        procedure_code = lab_slip_data.get('procedure_code', 'N/A')
-        procedure_desc = lab_slip_data.get('procedure_description', '')
         if procedure_desc:
-            c.drawString(1*inch, y_position, f"Procedure: {procedure_code} - {procedure_desc}")
+            draw_line(f"Procedure: {procedure_code} - {procedure_desc}")
         else:
-            c.drawString(1*inch, y_position, f"Procedure Code: {procedure_code}")
+            draw_line(f"Procedure Code: {procedure_code}")
         
-        if lab_slip_data.get('tooth_number'):
+        if tooth_number:
             y_position -= 0.15*inch
-            c.drawString(1*inch, y_position, f"Tooth Number: {lab_slip_data['tooth_number']}")
+            draw_line(f"Tooth Number: {tooth_number}")
         
-        if lab_slip_data.get('shade'):
+        if shade:
             y_position -= 0.15*inch
-            c.drawString(1*inch, y_position, f"Shade: {lab_slip_data['shade']}")
+            draw_line(f"Shade: {shade}")
         
-        if lab_slip_data.get('due_date'):
+        if due_date:
             y_position -= 0.15*inch
-            due_date = lab_slip_data['due_date']
             if isinstance(due_date, str):
-                c.drawString(1*inch, y_position, f"Due Date: {due_date}")
+                draw_line(f"Due Date: {due_date}")
             else:
-                c.drawString(1*inch, y_position, f"Due Date: {due_date.strftime('%m/%d/%Y')}")
+                draw_line(f"Due Date: {due_date.strftime('%m/%d/%Y')}")
         
         # Special Instructions Section
-        if lab_slip_data.get('special_instructions'):
+        if instructions:
             y_position -= 0.4*inch
-            c.setFont("Helvetica-Bold", 12)
-            c.drawString(1*inch, y_position, "SPECIAL INSTRUCTIONS")
+            text.setFont("Helvetica-Bold", 12)
+            draw_line("SPECIAL INSTRUCTIONS")
             
-            c.setFont("Helvetica", 10)
+            text.setFont("Helvetica", 10)
             y_position -= 0.25*inch
             
             # Handle multi-line instructions
-            instructions = lab_slip_data['special_instructions']
             max_width = width - 2*inch
             
-            # Simple word wrapping
-            words = instructions.split()
-            line = ""
-            for word in words:
-                test_line = line + word + " "
-                if c.stringWidth(test_line, "Helvetica", 10) < max_width:
-                    line = test_line
-                else:
-                    c.drawString(1*inch, y_position, line.strip())
+            # Greedy word wrapping, measuring each word once
+            space_width = stringWidth(" ", "Helvetica", 10)
+            line = []
+            line_width = 0
+            for word in instructions.split():
+                word_width = stringWidth(word, "Helvetica", 10) + space_width
+                if line and line_width + word_width >= max_width:
+                    draw_line(" ".join(line))
                     y_position -= 0.15*inch
-                    line = word + " "
+                    line = []
+                    line_width = 0
+                line.append(word)
+                line_width += word_width
             
             if line:
-                c.drawString(1*inch, y_position, line.strip())
+                draw_line(" ".join(line))
         
         # Footer with generation timestamp
-        c.setFont("Helvetica", 8)
+        text.setFont("Helvetica", 8)
         footer_text = f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        c.drawString(1*inch, 0.5*inch, footer_text)
+        text.setTextOrigin(1*inch, 0.5*inch)
+        text.textOut(footer_text)
         
         # Add lab slip ID if available
-        if lab_slip_data.get('id'):
-            c.drawString(width - 3*inch, 0.5*inch, f"Lab Slip ID: {lab_slip_data['id'][:8]}")
+        if slip_id:
+            text.setTextOrigin(width - 3*inch, 0.5*inch)
+            text.textOut(f"Lab Slip ID: {slip_id[:8]}")
+        
+        # Emit all body text as a single text object
+        c.drawText(text)
         
         # Save PDF
         c.save()
         
-        return output_path
+        if buffer is not None:
+            return buffer.getvalue()
+        return output
     
     def generate_from_database_record(self, record: Dict, output_dir: str = "/tmp") -> str:
         """
@@ -182,17 +246,41 @@ class LabSlipPDFGenerator:
         Returns:
             Path to generated PDF
         """
-        # Create filename
-        patient_name = record.get('patient_name', 'unknown').replace(' ', '_')
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"lab_slip_{patient_name}_{timestamp}.pdf"
-        output_path = os.path.join(output_dir, filename)
+        output_path = os.path.join(output_dir, self._filename_for_record(record))
+        return self.generate(self._pdf_data_from_record(record), output_path)
+    
+    def generate_and_upload(self, record: Dict, supabase_client,
+                            bucket: str = 'lab-slips') -> str:
+        """
+        Generate PDF from a database record in memory and upload it to Supabase Storage
         
+        Args:
+            record: Database record from lab_slips table
+            supabase_client: Supabase client instance
+            bucket: Storage bucket to upload into
+            
+        Returns:
+            Storage path of the uploaded PDF
+        """
+        pdf_bytes = self.generate(self._pdf_data_from_record(record))
+        storage_path = self._filename_for_record(record)
+        supabase_client.storage.from_(bucket).upload(
+            storage_path, pdf_bytes, {'content-type': 'application/pdf'}
+        )
+        return storage_path
+    
+    def _filename_for_record(self, record: Dict) -> str:
+        """Build the PDF filename for a database record"""
+        safe_name = (record.get('patient_name') or 'unknown').translate(_SAFE_TABLE)
+        return f"lab_slip_{safe_name}_{datetime.now():%Y%m%d_%H%M%S}.pdf"
+    
+    def _pdf_data_from_record(self, record: Dict) -> Dict:
+        """Map a lab_slips database record to generate() input"""
         # Extract lab information from lab_slip_data if available
         lab_data = record.get('lab_slip_data', {})
         
         # Prepare data for PDF generation
-        pdf_data = {
+        return {
             'id': record.get('id'),
             'patient_name': record.get('patient_name'),
             'patient_dob': record.get('patient_dob'),
@@ -206,8 +294,19 @@ class LabSlipPDFGenerator:
             'lab_contact': lab_data.get('lab_contact'),
             'lab_email': lab_data.get('lab_email')
         }
+    
+    def generate_many(self, records: List[Dict], output_dir: str = "/tmp") -> List[str]:
+        """
+        Generate PDFs for many database records with this generator instance
         
-        return self.generate(pdf_data, output_path)
+        Args:
+            records: Database records from lab_slips table
+            output_dir: Directory to save PDFs
+            
+        Returns:
+            Paths to generated PDFs
+        """
+        return [self.generate_from_database_record(record, output_dir) for record in records]
 
 
 def main():
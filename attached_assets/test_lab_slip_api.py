@@ -0,0 +1,363 @@
+"""
+Lab Slip API Tests
+Tests QueryCache, get_lab_slip caching and single-flight behavior, and bulk inserts
+against a fake Supabase client
+"""
+from lab_slip_api import BULK_INSERT_CHUNK_SIZE, LabSlipAPI, QueryCache
+from datetime import datetime
+import threading
+import time
+
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    """Query builder that reads the fake database when executed"""
+
+    def __init__(self, client, lab_slip_id=None):
+        self.client = client
+        self.lab_slip_id = lab_slip_id
+
+    def select(self, *args):
+        return self
+
+    def single(self):
+        return self
+
+    def eq(self, column, value):
+        return FakeQuery(self.client, value)
+
+    def insert(self, payload):
+        return FakeInsert(self.client, payload)
+
+    def execute(self):
+        return self.client.read(self.lab_slip_id)
+
+
+class FakeInsert:
+    def __init__(self, client, payload):
+        self.client = client
+        self.payload = payload
+
+    def execute(self):
+        return self.client.insert(self.payload)
+
+
+class FakeRPC:
+    def __init__(self, client, params):
+        self.client = client
+        self.params = params
+
+    def execute(self):
+        row = self.client.rows[self.params['p_lab_slip_id']]
+        row['status'] = self.params['p_status']
+        return FakeResult([dict(row)])
+
+
+class FakeSupabase:
+    """
+    Minimal Supabase stand-in
+
+    Reads snapshot the row, then (while block_reads is set) wait on release
+    before returning, so tests can interleave other calls with an in-flight read.
+    """
+
+    def __init__(self):
+        self.rows = {'slip-1': {'id': 'slip-1', 'status': 'pending'}}
+        self.calls = 0
+        self.error = None
+        self.inserts = []
+        self.fail_insert = None
+        self.block_reads = threading.Event()
+        self.read_started = threading.Event()
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def table(self, name):
+        return FakeQuery(self)
+
+    def rpc(self, name, params):
+        return FakeRPC(self, params)
+
+    def insert(self, payload):
+        """Record an insert payload, raising on the fail_insert-th call (0-based)"""
+        if len(self.inserts) == self.fail_insert:
+            raise RuntimeError('insert failed')
+        self.inserts.append(payload)
+        return FakeResult(payload)
+
+    def read(self, lab_slip_id):
+        with self._lock:
+            self.calls += 1
+            blocking = self.block_reads.is_set()
+            snapshot = dict(self.rows[lab_slip_id])
+        if blocking:
+            self.block_reads.clear()
+            self.read_started.set()
+            self.release.wait(5)
+        if self.error:
+            raise self.error
+        return FakeResult(snapshot)
+
+
+def test_cache_entry_expires_after_ttl():
+    """An entry past its TTL is a miss and is removed"""
+    cache = QueryCache(default_ttl=60)
+    cache.set('fresh', 1)
+    cache.set('expired', 2, ttl=-1)
+
+    assert cache.get('fresh') == 1
+    assert cache.get('expired') is None
+    assert cache.stats()['size'] == 1
+
+
+def test_cache_evicts_least_recently_used():
+    """Exceeding max_size evicts the entry used least recently"""
+    cache = QueryCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_cache_stats_count_hits_and_misses():
+    """stats() reports hits, misses and current size"""
+    cache = QueryCache()
+    cache.get('missing')
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('a')
+    cache.invalidate('a')
+    cache.get('a')
+
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'size': 0}
+
+
+def test_cache_forgets_generations_without_readers():
+    """Generations are only kept while a reader holds one"""
+    cache = QueryCache()
+    for i in range(100):
+        cache.invalidate(('lab_slip', i))
+    assert cache._generations == {}
+
+    generation = cache.generation('a')
+    cache.invalidate('a')
+    cache.set('a', 1, generation=generation)
+    cache.release_generation('a')
+
+    assert cache.get('a') is None
+    assert cache._generations == {}
+
+
+def start_get(api, results, lab_slip_id='slip-1', name=None):
+    """Run get_lab_slip in a thread, appending its result or exception"""
+    def run():
+        try:
+            results.append(api.get_lab_slip(lab_slip_id))
+        except Exception as e:
+            results.append(e)
+
+    thread = threading.Thread(target=run, name=name)
+    thread.start()
+    return thread
+
+
+def wait_for_waiters(api, count, lab_slip_id='slip-1'):
+    """Block until count threads are waiting on the in-flight query for lab_slip_id"""
+    future = api._inflight[lab_slip_id]
+    deadline = time.monotonic() + 5
+    while len(future._condition._waiters) < count:
+        assert time.monotonic() < deadline, "waiters did not join the in-flight query"
+        time.sleep(0.001)
+
+
+def test_concurrent_gets_share_one_query():
+    """N concurrent get_lab_slip calls for one id issue a single query"""
+    client = FakeSupabase()
+    api = LabSlipAPI(client)
+    client.block_reads.set()
+
+    results = []
+    threads = [start_get(api, results)]
+    assert client.read_started.wait(5)
+    threads += [start_get(api, results) for _ in range(4)]
+    wait_for_waiters(api, 4)
+    client.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert client.calls == 1
+    assert results == [{'id': 'slip-1', 'status': 'pending'}] * 5
+
+
+def test_error_reaches_all_waiters():
+    """A failed query is raised to the owner and every waiter"""
+    client = FakeSupabase()
+    client.error = RuntimeError('connection reset')
+    api = LabSlipAPI(client)
+    client.block_reads.set()
+
+    results = []
+    threads = [start_get(api, results)]
+    assert client.read_started.wait(5)
+    threads += [start_get(api, results) for _ in range(4)]
+    wait_for_waiters(api, 4)
+    client.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(results) == 5
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert api._inflight == {}
+
+
+def test_update_during_inflight_get_is_not_cached():
+    """A read that started before a status update must not cache or serve the old row"""
+    client = FakeSupabase()
+    api = LabSlipAPI(client)
+    client.block_reads.set()
+
+    stale = []
+    stale_thread = start_get(api, stale)
+    assert client.read_started.wait(5)
+
+    api.update_lab_slip_status('slip-1', 'sent')
+
+    # Callers after the update start a fresh query instead of joining the old one
+    assert api.get_lab_slip('slip-1')['status'] == 'sent'
+
+    client.release.set()
+    stale_thread.join(5)
+    assert stale == [{'id': 'slip-1', 'status': 'pending'}]
+
+    # The in-flight read finished last but must not overwrite the cache
+    assert api.get_lab_slip('slip-1')['status'] == 'sent'
+    assert client.calls == 2
+    assert api.cache._generations == {}
+
+
+def test_owner_mutation_does_not_reach_waiters():
+    """The caller that ran the query may mutate its result without waiters seeing it"""
+    import lab_slip_api
+
+    client = FakeSupabase()
+    api = LabSlipAPI(client)
+    client.block_reads.set()
+    owner_mutated = threading.Event()
+    real_deepcopy = lab_slip_api.copy.deepcopy
+
+    def deepcopy_after_owner_mutates(value, *args):
+        # Hold waiters until the owner has mutated its result
+        if threading.current_thread().name.startswith('waiter'):
+            assert owner_mutated.wait(5)
+        return real_deepcopy(value, *args)
+
+    def owner():
+        api.get_lab_slip('slip-1')['status'] = 'MUTATED_BY_OWNER'
+        owner_mutated.set()
+
+    lab_slip_api.copy.deepcopy = deepcopy_after_owner_mutates
+    try:
+        owner_thread = threading.Thread(target=owner)
+        owner_thread.start()
+        assert client.read_started.wait(5)
+
+        results = []
+        waiters = [start_get(api, results, name=f'waiter-{i}') for i in range(3)]
+        wait_for_waiters(api, 3)
+        client.release.set()
+        owner_thread.join(5)
+        for waiter in waiters:
+            waiter.join(5)
+    finally:
+        lab_slip_api.copy.deepcopy = real_deepcopy
+
+    assert results == [{'id': 'slip-1', 'status': 'pending'}] * 3
+
+
+def procedures(count, **fields):
+    """Build count minimal procedure dicts for create_lab_slips_bulk"""
+    return [dict({'patient_name': f'Patient {i}', 'procedure_code': 'D2740'}, **fields)
+            for i in range(count)]
+
+
+def test_bulk_insert_is_chunked():
+    """Rows are sent in BULK_INSERT_CHUNK_SIZE inserts and all created rows are returned"""
+    client = FakeSupabase()
+    api = LabSlipAPI(client)
+
+    created = api.create_lab_slips_bulk(procedures(BULK_INSERT_CHUNK_SIZE * 2 + 1))
+
+    assert [len(chunk) for chunk in client.inserts] == [BULK_INSERT_CHUNK_SIZE, BULK_INSERT_CHUNK_SIZE, 1]
+    assert len(created) == BULK_INSERT_CHUNK_SIZE * 2 + 1
+    assert created[-1]['patient_name'] == f'Patient {BULK_INSERT_CHUNK_SIZE * 2}'
+
+
+def test_bulk_insert_failure_invalidates_pending():
+    """A failing later chunk still invalidates the pending cache for the committed ones"""
+    client = FakeSupabase()
+    client.fail_insert = 1
+    api = LabSlipAPI(client)
+    api.cache.set(('pending',), [])
+
+    try:
+        api.create_lab_slips_bulk(procedures(BULK_INSERT_CHUNK_SIZE + 1))
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("insert failure was not raised")
+
+    assert len(client.inserts) == 1
+    assert api.cache.get(('pending',)) is None
+
+
+def test_row_without_due_date_leaves_it_to_the_column_default():
+    """LabSlipRow.to_dict() omits due_date when it is unset"""
+    api = LabSlipAPI(FakeSupabase())
+    row = api._build_row(procedures(1)[0])
+
+    assert 'due_date' not in row.to_dict()
+    row.due_date = '2030-01-01'
+    assert row.to_dict()['due_date'] == '2030-01-01'
+
+
+def test_bulk_insert_without_due_dates_omits_the_column():
+    """When no row sets due_date, no row in the payload carries it"""
+    client = FakeSupabase()
+    LabSlipAPI(client).create_lab_slips_bulk(procedures(3))
+
+    assert all('due_date' not in row for row in client.inserts[0])
+
+
+def test_bulk_insert_with_some_due_dates_fills_the_rest():
+    """When any row sets due_date, every row carries it and unset rows get the default"""
+    client = FakeSupabase()
+    api = LabSlipAPI(client)
+    rows = procedures(3)
+    rows[1]['due_date'] = '2030-01-01'
+
+    api.create_lab_slips_bulk(rows)
+
+    default = api._default_due_date(datetime.now())
+    assert [row['due_date'] for row in client.inserts[0]] == [default, '2030-01-01', default]
+
+
+def test_cached_result_is_a_copy():
+    """Mutating a returned lab slip does not change the cached entry"""
+    api = LabSlipAPI(FakeSupabase())
+    api.get_lab_slip('slip-1')['status'] = 'mutated'
+    assert api.get_lab_slip('slip-1')['status'] == 'pending'
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print(f"✓ {name}")
@@ -0,0 +1,60 @@
+-- Migration: Add append_lab_slip_status RPC
+-- Created: 2026-10-15
+-- Purpose: Update a lab slip's status and append to lab_slip_data.status_history in a single
+--          statement, so the API no longer has to read the row before writing it back
+
+BEGIN;
+
+-- ============================================
+-- STEP 1: Create status update function
+-- ============================================
+
+-- Sets status/updated_at, stamps sent_at or completed_at, and appends a
+-- status_history entry when notes are supplied. Returns the updated row.
+CREATE OR REPLACE FUNCTION append_lab_slip_status(
+  p_lab_slip_id TEXT,
+  p_status TEXT,
+  p_notes TEXT DEFAULT NULL,
+  p_ts TIMESTAMP DEFAULT NOW()
+)
+RETURNS SETOF lab_slips
+LANGUAGE sql
+AS $$
+  UPDATE lab_slips
+  SET
+    status = p_status,
+    updated_at = p_ts,
+    sent_at = CASE WHEN p_status = 'sent' THEN p_ts ELSE sent_at END,
+    completed_at = CASE WHEN p_status = 'completed' THEN p_ts ELSE completed_at END,
+    lab_slip_data = CASE
+      WHEN p_notes IS NULL THEN lab_slip_data
+      ELSE jsonb_set(
+        COALESCE(lab_slip_data, '{}'::jsonb),
+        '{status_history}',
+        COALESCE(lab_slip_data->'status_history', '[]'::jsonb)
+          || jsonb_build_array(jsonb_build_object(
+               'status', p_status,
+               'notes', p_notes,
+               'timestamp', p_ts
+             ))
+      )
+    END
+  WHERE id = p_lab_slip_id
+  RETURNING *;
+$$;
+
+COMMENT ON FUNCTION append_lab_slip_status(TEXT, TEXT, TEXT, TIMESTAMP) IS 'Atomically update lab slip status and append to lab_slip_data.status_history';
+
+COMMIT;
+
+-- Reload PostgREST schema cache so the RPC is exposed
+NOTIFY pgrst, 'reload schema';
+
+-- ============================================
+-- VERIFICATION QUERIES
+-- ============================================
+
+-- Verify function exists
+SELECT proname, pg_get_function_arguments(oid)
+FROM pg_proc
+WHERE proname = 'append_lab_slip_status';
@@ -0,0 +1,37 @@
+-- Migration: Default lab_slips.due_date to two weeks out
+-- Created: 2026-10-15
+-- Purpose: Let LabSlipAPI omit due_date on insert so the database clock sets it,
+--          including for multi-row inserts from create_lab_slips_bulk
+
+BEGIN;
+
+-- ============================================
+-- STEP 1: Set due_date column default
+-- ============================================
+
+-- due_date is TEXT in the original schema and may have been changed to DATE;
+-- store an ISO date string for TEXT columns
+DO $$
+BEGIN
+  IF (
+    SELECT data_type FROM information_schema.columns
+    WHERE table_name = 'lab_slips'
+    AND column_name = 'due_date'
+  ) = 'date' THEN
+    ALTER TABLE lab_slips ALTER COLUMN due_date SET DEFAULT (CURRENT_DATE + 14);
+  ELSE
+    ALTER TABLE lab_slips ALTER COLUMN due_date SET DEFAULT to_char(CURRENT_DATE + 14, 'YYYY-MM-DD');
+  END IF;
+END $$;
+
+COMMIT;
+
+-- ============================================
+-- VERIFICATION QUERIES
+-- ============================================
+
+-- Verify column default
+SELECT column_name, data_type, column_default
+FROM information_schema.columns
+WHERE table_name = 'lab_slips'
+AND column_name = 'due_date';
@@ -0,0 +1,41 @@
+-- Migration: Add indexes for lab slip list and overdue queries
+-- Created: 2026-10-15
+-- Purpose: Back LabSlipAPI.get_overdue_lab_slips and list_lab_slips(status=...) with indexes
+--          so they no longer scan the whole lab_slips table
+
+BEGIN;
+
+-- ============================================
+-- STEP 1: Create indexes
+-- ============================================
+
+-- Partial index for overdue lookups: due_date < today, not completed/cancelled, ordered by due_date.
+-- The predicate matches the query's two neq filters; INCLUDE covers the default list projection.
+CREATE INDEX IF NOT EXISTS idx_lab_slips_overdue
+ON lab_slips(due_date)
+INCLUDE (id, patient_name, procedure_code, status, lab_id)
+WHERE status <> 'completed' AND status <> 'cancelled';
+
+-- Composite index for status filtering with newest-first ordering
+CREATE INDEX IF NOT EXISTS idx_lab_slips_status_created_at
+ON lab_slips(status, created_at DESC);
+
+-- ============================================
+-- STEP 2: Drop superseded index
+-- ============================================
+
+-- idx_lab_slips_status (add_crown_work_order_fields.sql) is a prefix of
+-- idx_lab_slips_status_created_at, which serves the same status lookups
+DROP INDEX IF EXISTS idx_lab_slips_status;
+
+COMMIT;
+
+-- ============================================
+-- VERIFICATION QUERIES
+-- ============================================
+
+-- Show indexes
+SELECT indexname, indexdef
+FROM pg_indexes
+WHERE tablename = 'lab_slips'
+ORDER BY indexname;
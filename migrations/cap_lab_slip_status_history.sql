@@ -0,0 +1,70 @@
+-- Migration: Cap lab_slip_data.status_history at 50 entries
+-- Created: 2026-10-15
+-- Purpose: Replace append_lab_slip_status (add_append_lab_slip_status_function.sql) so that
+--          status_history keeps only the 50 most recent entries and row size stays bounded
+
+BEGIN;
+
+-- ============================================
+-- STEP 1: Replace status update function
+-- ============================================
+
+-- Same as before, but after appending, status_history is trimmed to the
+-- last 50 entries (oldest dropped, chronological order kept).
+CREATE OR REPLACE FUNCTION append_lab_slip_status(
+  p_lab_slip_id TEXT,
+  p_status TEXT,
+  p_notes TEXT DEFAULT NULL,
+  p_ts TIMESTAMP DEFAULT NOW()
+)
+RETURNS SETOF lab_slips
+LANGUAGE sql
+AS $$
+  UPDATE lab_slips
+  SET
+    status = p_status,
+    updated_at = p_ts,
+    sent_at = CASE WHEN p_status = 'sent' THEN p_ts ELSE sent_at END,
+    completed_at = CASE WHEN p_status = 'completed' THEN p_ts ELSE completed_at END,
+    lab_slip_data = CASE
+      WHEN p_notes IS NULL THEN lab_slip_data
+      ELSE jsonb_set(
+        COALESCE(lab_slip_data, '{}'::jsonb),
+        '{status_history}',
+        (
+          SELECT jsonb_agg(recent.entry ORDER BY recent.ord)
+          FROM (
+            SELECT entry, ord
+            FROM jsonb_array_elements(
+              COALESCE(lab_slip_data->'status_history', '[]'::jsonb)
+                || jsonb_build_array(jsonb_build_object(
+                     'status', p_status,
+                     'notes', p_notes,
+                     'timestamp', p_ts
+                   ))
+            ) WITH ORDINALITY AS history(entry, ord)
+            ORDER BY ord DESC
+            LIMIT 50
+          ) recent
+        )
+      )
+    END
+  WHERE id = p_lab_slip_id
+  RETURNING *;
+$$;
+
+COMMENT ON FUNCTION append_lab_slip_status(TEXT, TEXT, TEXT, TIMESTAMP) IS 'Atomically update lab slip status and append to lab_slip_data.status_history (capped at 50 entries)';
+
+COMMIT;
+
+-- Reload PostgREST schema cache
+NOTIFY pgrst, 'reload schema';
+
+-- ============================================
+-- VERIFICATION QUERIES
+-- ============================================
+
+-- Verify function definition
+SELECT proname, pg_get_function_arguments(oid)
+FROM pg_proc
+WHERE proname = 'append_lab_slip_status';